@@ -1,12 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
-import random
-from tokyo_helpers import query_station_status, get_station_latlon
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from tokyo_helpers import fetch_json, parse_station_status, parse_station_latlon
 
 # Page configuration
 st.set_page_config(
@@ -38,25 +43,15 @@ st.markdown("""
 station_status_url = "https://api-public.odpt.org/api/v4/gbfs/docomo-cycle-tokyo/station_status.json"
 station_info_url = "https://api-public.odpt.org/api/v4/gbfs/docomo-cycle-tokyo/station_information.json"
 
-# Fetch live data from APIs
-station_status_df = query_station_status(station_status_url)
-station_info_df = get_station_latlon(station_info_url)
-
-# Merge data on station_id
-df = station_status_df.merge(station_info_df, on="station_id", how="left")
-
-def get_random_availability(capacity):
-    """Generate random bike availability"""
-    return random.randint(0, capacity)
-
-def get_status_color(bikes_available):
-    """Determine status color based on availability"""
-    if bikes_available > 3:
-        return "green"
-    elif bikes_available > 0:
-        return "orange"
-    else:
-        return "red"
+@st.cache_data(ttl=300, show_spinner=False)  # Reuse the merged station list across reruns; no spinner since the refresher thread calls it too
+def load_stations_base(status_url, info_url):
+    """Fetch live station status and info, merged on station_id"""
+    # Both endpoints are plain I/O, so fetch them in parallel
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        status_json, info_json = ex.map(fetch_json, [status_url, info_url])
+    return parse_station_status(status_json).merge(
+        parse_station_latlon(info_json), on="station_id", how="left"
+    ).to_dict(orient='records')
 
 def format_timestamp(ts):
     """Format timestamp to readable datetime"""
@@ -68,21 +63,181 @@ def calculate_utilization(bikes_available, capacity):
         return 0
     return round((bikes_available / capacity) * 100, 2)
 
-stations_base = station_status_df.merge(station_info_df, on="station_id", how="left")
+def calculate_utilization_rates(df):
+    """Calculate utilization percentage for every station at once"""
+    cap = df['capacity'].to_numpy()
+    bikes = df['bikes_available'].to_numpy()
+    return np.where(cap == 0, 0.0, np.round(bikes / np.maximum(cap, 1) * 100, 2))
+
+# Compact dtypes for the station DataFrame kept in session state
+STATION_DTYPES = {
+    'capacity': 'int32',
+    'bikes_available': 'int32',
+    'docks_available': 'int32',
+    'region_id': 'category',
+    'name': 'string[python]',
+}
+
+def top_n_positions(values, n):
+    """Row positions of the n largest values, ties kept in row order like nlargest"""
+    if len(values) <= n:
+        return np.argsort(-values, kind='stable')
+    threshold = np.partition(values, -n)[-n]  # n-th largest value in one O(n) pass
+    above = np.flatnonzero(values > threshold)
+    ties = np.flatnonzero(values == threshold)[:n - len(above)]
+    idx = np.concatenate([above, ties])
+    return idx[np.argsort(-values[idx], kind='stable')]
+
+def init_station_state(stations_base):
+    """Publish station data with simulated availability to session state"""
+    df = pd.DataFrame(stations_base)
+    caps = df['capacity'].to_numpy()
+    df['bikes_available'] = np.random.randint(0, caps + 1)
+    df['docks_available'] = caps - df['bikes_available'].to_numpy()
+    df['is_renting'] = True
+    df['is_returning'] = True
+    df['is_installed'] = True
+    df = df.astype(STATION_DTYPES)
+    df['utilization_rate'] = calculate_utilization_rates(df)
+    df['region_id_str'] = df['region_id'].astype(str).astype('category')  # For region filtering without per-rerun casts
+    names = df['name'].tolist()
+    
+    # Build everything first and publish it in one assignment, so a rerun
+    # never sees values from two different refreshes
+    st.session_state.station_data = {
+        'last_update': datetime.now(),
+        'df': df,
+        'station_views': {},  # Filtered/sorted views of this data, see get_station_view
+        'regions_sorted': sorted(map(str, df['region_id'].unique())),
+        'region_counts': df['region_id'].value_counts(),
+        'station_names': list(dict.fromkeys(names)),  # Unique names in first-seen order
+        'name_to_idx': {name: i for i, name in reversed(list(enumerate(names)))},  # First row per name
+    }
+
+def get_station_view(data, sort_col, region):
+    """Return stations in a region sorted by sort_col, reusing earlier results"""
+    key = (sort_col, region)
+    views = data['station_views']
+    if key not in views:
+        view = data['df']
+        if region != "All":
+            view = view[view['region_id_str'] == region]
+        views[key] = view.sort_values(sort_col, ascending=False)
+    return views[key]
+
+# Seconds between background refreshes of the station data
+REFRESH_INTERVAL = 300
+
+def _refresher(status_url, info_url):
+    """Refresh this session's station data on a timer until the session ends"""
+    session_id = get_script_run_ctx().session_id
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        if not Runtime.instance().is_active_session(session_id):
+            return  # Browser tab closed, stop refreshing
+        try:
+            init_station_state(load_stations_base(status_url, info_url))
+        except Exception as e:
+            print(f"Error refreshing station data: {e}")  # Keep the previous data and retry next time
+
+def start_refresher(status_url, info_url):
+    """Start the background refresher thread once per session"""
+    if 'refresher_started' in st.session_state:
+        return
+    st.session_state.refresher_started = True
+    t = threading.Thread(target=_refresher, args=(status_url, info_url), daemon=True)
+    add_script_run_ctx(t)  # Give the thread access to this session's state
+    t.start()
+
+# Columns shown in the stations table and their display labels
+DISPLAY_LABELS = {
+    'station_id': 'Station ID',
+    'name': 'Station Name',
+    'bikes_available': 'Bikes Available',
+    'capacity': 'Capacity',
+    'docks_available': 'Docks Available',
+    'utilization_rate': 'Utilization %',
+    'region_id': 'Region',
+}
+DISPLAY_COLS = list(DISPLAY_LABELS)
+DISPLAY_CFG = {col: st.column_config.Column(label=label) for col, label in DISPLAY_LABELS.items()}
+
+# Columns needed to draw the station map
+MAP_COLS = ['name', 'bikes_available', 'capacity', 'docks_available', 'region_id', 'station_id', 'lat', 'lon']
+
+def build_station_map(df):
+    """Build the folium map with one marker per station"""
+    # Create map centered on Tokyo
+    tokyo_center = [35.6762, 139.6503]
+    m = folium.Map(
+        location=tokyo_center,
+        zoom_start=12,
+        tiles="OpenStreetMap",
+        prefer_canvas=True  # Draw markers on one canvas instead of an SVG element each
+    )
+    
+    # Build all popup texts up front
+    popups = (
+        '<b>' + df['name'].astype(str) + '</b><br>'
+        + 'Bikes: ' + df['bikes_available'].astype(str) + '/' + df['capacity'].astype(str) + '<br>'
+        + 'Docks: ' + df['docks_available'].astype(str) + '<br>'
+        + 'Region ID: ' + df['region_id'].astype(str) + '<br>'
+        + 'Station ID: ' + df['station_id'].astype(str)
+    ).to_numpy()
+    
+    # Status colors and marker sizes based on availability
+    b = df['bikes_available'].to_numpy()
+    colors = np.where(b > 3, "green", np.where(b > 0, "orange", "red"))
+    radii = 8 + (b / np.maximum(df['capacity'].to_numpy(), 1)) * 5
+    
+    # Add station markers
+    for lat, lon, radius, color, popup_text in zip(
+        df['lat'].to_numpy(), df['lon'].to_numpy(), radii, colors, popups
+    ):
+        folium.CircleMarker(
+            location=[lat, lon],
+            radius=radius,
+            popup=folium.Popup(popup_text, max_width=250),
+            color=color,
+            fill=True,
+            fillColor=color,
+            fillOpacity=0.7,
+            weight=2
+        ).add_to(m)
+    
+    return m
+
+# Analytics figures are cached on the plotted values so unchanged data skips rebuilding them
+@st.cache_data(max_entries=10)
+def build_bike_hist(bikes):
+    """Build the bikes available histogram"""
+    return px.histogram(pd.DataFrame({'bikes_available': bikes}), x='bikes_available', nbins=15, title="Distribution of Bikes Available")
 
-stations_base = stations_base.to_dict(orient='records')
+@st.cache_data(max_entries=10)
+def build_region_pie(counts, regions):
+    """Build the stations by region pie chart"""
+    return px.pie(values=counts, names=regions, title="Stations by Region")
+
+@st.cache_data(max_entries=10)
+def build_utilization_hist(rates):
+    """Build the utilization rate histogram"""
+    return px.histogram(pd.DataFrame({'utilization_rate': rates}), x='utilization_rate', nbins=15, title="Utilization Rate Distribution", labels={'utilization_rate': 'Utilization %'})
+
+@st.cache_data(max_entries=10)
+def build_capacity_scatter(capacity, bikes, names):
+    """Build the capacity vs bikes available scatter plot"""
+    return px.scatter(pd.DataFrame({'capacity': capacity, 'bikes_available': bikes, 'name': names}), x='capacity', y='bikes_available', hover_data=['name'], title="Capacity vs Bikes Available")
+
+# Fetch live data from APIs
+stations_base = load_stations_base(station_status_url, station_info_url)
 
 # Initialize or update session state
-if 'last_update' not in st.session_state:
-    st.session_state.last_update = datetime.now()
-    st.session_state.stations = []
-    for station in stations_base:
-        station['bikes_available'] = get_random_availability(station['capacity'])
-        station['docks_available'] = station['capacity'] - station['bikes_available']
-        station['is_renting'] = True
-        station['is_returning'] = True
-        station['is_installed'] = True
-        st.session_state.stations.append(station)
+if 'station_data' not in st.session_state:
+    init_station_state(stations_base)
+start_refresher(station_status_url, station_info_url)
+
+# Read the station data once so this run uses a single consistent snapshot
+data = st.session_state.station_data
 
 # Sidebar navigation
 st.sidebar.title("Tokyo Bike Tracker")
@@ -98,7 +253,7 @@ page = st.sidebar.radio(
 if page == "Dashboard":
     st.title("Tokyo Bike Status Dashboard")
     
-    df = pd.DataFrame(st.session_state.stations)
+    df = data['df']
     
     # Key metrics
     col1, col2, col3, col4 = st.columns(4)
@@ -115,7 +270,7 @@ if page == "Dashboard":
         st.metric("Total Docks Available", int(total_docks))
     
     with col4:
-        last_update_time = st.session_state.last_update.strftime("%H:%M:%S")
+        last_update_time = data['last_update'].strftime("%H:%M:%S")
         st.metric("Last Updated", last_update_time)
     
     st.markdown("---")
@@ -147,23 +302,12 @@ if page == "Dashboard":
 elif page == "Stations":
     st.title("All Stations")
     
-    df = pd.DataFrame(st.session_state.stations)
-    
-    # Add utilization rate
-    df['utilization_rate'] = df.apply(
-        lambda row: calculate_utilization(row['bikes_available'], row['capacity']), axis=1
-    )
-    
     # Region filter
-    regions = df['region_id'].unique()
     region_filter = st.selectbox(
         "Filter by Region ID:",
-        ["All"] + sorted(map(str, regions))
+        ["All"] + data['regions_sorted']
     )
     
-    if region_filter != "All":
-        df = df[df['region_id'].astype(str) == region_filter]
-    
     # Sort options
     sort_by = st.selectbox(
         "Sort by:",
@@ -177,66 +321,39 @@ elif page == "Stations":
         "Capacity": "capacity"
     }
     
-    df = df.sort_values(sort_map[sort_by], ascending=False)
+    df = get_station_view(data, sort_map[sort_by], region_filter)
     
     # Display table
-    display_df = df[['station_id', 'name', 'bikes_available', 'capacity', 'docks_available', 'utilization_rate', 'region_id']].copy()
-    display_df.columns = ['Station ID', 'Station Name', 'Bikes Available', 'Capacity', 'Docks Available', 'Utilization %', 'Region']
-    
-    st.dataframe(display_df, use_container_width=True)
+    st.dataframe(df[DISPLAY_COLS], column_config=DISPLAY_CFG, use_container_width=True)
 
 # Map Page
 elif page == "Map":
     st.title("Map_Tokyo")
     
-    df = pd.DataFrame(st.session_state.stations)
+    df = data['df']
     
-    # Create map centered on Tokyo
-    tokyo_center = [35.6762, 139.6503]
-    m = folium.Map(
-        location=tokyo_center,
-        zoom_start=12,
-        tiles="OpenStreetMap"
-    )
+    # Only rebuild the map HTML when availability has changed
+    map_hash = hash((df['bikes_available'].to_numpy().tobytes(), df['docks_available'].to_numpy().tobytes()))
+    if map_hash != st.session_state.get('map_hash'):
+        m = build_station_map(df[MAP_COLS])  # Only the columns the markers use
+        st.session_state.map_html = m.get_root().render()
+        st.session_state.map_hash = map_hash
     
-    # Add station markers
-    for idx, row in df.iterrows():
-        color = get_status_color(row['bikes_available'])
-        
-        popup_text = f"""
-        <b>{row['name']}</b><br>
-        Bikes: {row['bikes_available']}/{row['capacity']}<br>
-        Docks: {row['docks_available']}<br>
-        Region ID: {row['region_id']}<br>
-        Station ID: {row['station_id']}
-        """
-        
-        folium.CircleMarker(
-            location=[row['lat'], row['lon']],
-            radius=8 + (row['bikes_available'] / max (row['capacity'],1)) * 5,
-            popup=folium.Popup(popup_text, max_width=250),
-            color=color,
-            fill=True,
-            fillColor=color,
-            fillOpacity=0.7,
-            weight=2
-        ).add_to(m)
-    
-    st_folium(m, width=1400, height=600)
+    components.html(st.session_state.map_html, width=1400, height=600)
 
 # Search Page
 elif page == "Search":
     st.title("Station Details")
     
-    df = pd.DataFrame(st.session_state.stations)
+    df = data['df']
     
     # Select station
     station_name = st.selectbox(
         "Select a Station:",
-        df['name'].unique()
+        data['station_names']
     )
     
-    station_data = df[df['name'] == station_name].iloc[0]
+    station_data = df.iloc[data['name_to_idx'][station_name]]
     
     # Display station details
     col1, col2 = st.columns(2)
@@ -278,23 +395,20 @@ elif page == "Search":
 elif page == "Analytics":
     st.title("Analytics & Statistics")
     
-    df = pd.DataFrame(st.session_state.stations)
-    df['utilization_rate'] = df.apply(
-        lambda row: calculate_utilization(row['bikes_available'], row['capacity']), axis=1
-    )
+    df = data['df']
     
     # Charts
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Bike Availability Distribution")
-        fig = px.histogram(df, x='bikes_available', nbins=15, title="Distribution of Bikes Available")
+        fig = build_bike_hist(tuple(df['bikes_available'].tolist()))
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Stations by Region")
-        region_counts = df['region_id'].value_counts()
-        fig = px.pie(values=region_counts.values, names=region_counts.index, title="Stations by Region")
+        region_counts = data['region_counts']
+        fig = build_region_pie(tuple(region_counts.tolist()), tuple(region_counts.index.tolist()))
         st.plotly_chart(fig, use_container_width=True)
     
     st.markdown("---")
@@ -303,12 +417,12 @@ elif page == "Analytics":
     
     with col1:
         st.subheader("Utilization Rate Distribution")
-        fig = px.histogram(df, x='utilization_rate', nbins=15, title="Utilization Rate Distribution", labels={'utilization_rate': 'Utilization %'})
+        fig = build_utilization_hist(tuple(df['utilization_rate'].tolist()))
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         st.subheader("Capacity vs Bikes Available")
-        fig = px.scatter(df, x='capacity', y='bikes_available', hover_data=['name'], title="Capacity vs Bikes Available")
+        fig = build_capacity_scatter(tuple(df['capacity'].tolist()), tuple(df['bikes_available'].tolist()), tuple(df['name'].tolist()))
         st.plotly_chart(fig, use_container_width=True)
     
     st.markdown("---")
@@ -317,12 +431,12 @@ elif page == "Analytics":
     
     with col1:
         st.subheader("Top 5 Stations with Most Bikes")
-        top_bikes = df.nlargest(5, 'bikes_available')[['name', 'bikes_available', 'capacity']]
+        top_bikes = df.iloc[top_n_positions(df['bikes_available'].to_numpy(), 5)][['name', 'bikes_available', 'capacity']]
         st.dataframe(top_bikes, use_container_width=True)
     
     with col2:
         st.subheader("Top 5 Stations with Most Empty Docks")
-        top_docks = df.nlargest(5, 'docks_available')[['name', 'docks_available', 'capacity']]
+        top_docks = df.iloc[top_n_positions(df['docks_available'].to_numpy(), 5)][['name', 'docks_available', 'capacity']]
         st.dataframe(top_docks, use_container_width=True)
 
 # Settings Page
@@ -332,15 +446,7 @@ elif page == "Settings":
     st.subheader("Data Management")
     
     if st.button("Refresh Data", key="refresh_button"):
-        st.session_state.last_update = datetime.now()
-        st.session_state.stations = []
-        for station in stations_base:
-            station['bikes_available'] = get_random_availability(station['capacity'])
-            station['docks_available'] = station['capacity'] - station['bikes_available']
-            station['is_renting'] = True
-            station['is_returning'] = True
-            station['is_installed'] = True
-            st.session_state.stations.append(station)
+        init_station_state(stations_base)
         st.success("Data refreshed!")
         st.rerun()
     
@@ -352,12 +458,12 @@ elif page == "Settings":
     with info_col1:
         st.write("**Application Name:** Tokyo Bike Status Tracker")
         st.write("**Version:** 1.0.0")
-        st.write("**Last Updated:** " + st.session_state.last_update.strftime("%Y-%m-%d %H:%M:%S"))
+        st.write("**Last Updated:** " + data['last_update'].strftime("%Y-%m-%d %H:%M:%S"))
     
     with info_col2:
-        st.write("**Total Stations:** " + str(len(st.session_state.stations)))
+        st.write("**Total Stations:** " + str(len(data['df'])))
         st.write("**Data Source:** Sample Data (Real API Integration Available)")
-        st.write("**Update Frequency:** Manual/On Demand")
+        st.write(f"**Update Frequency:** Every {REFRESH_INTERVAL // 60} minutes or On Demand")
     
     st.markdown("---")
     st.subheader("About")
@@ -1,42 +1,46 @@
-import urllib  # Import module for working with URLs
-import json  # Import module for working with JSON data
+import orjson  # Import orjson for fast JSON parsing
 import pandas as pd  # Import pandas for data manipulation
-import folium  # Import folium for creating interactive maps
-import datetime as dt  # Import datetime for working with dates and times
-from geopy.distance import geodesic  # Import geodesic for calculating distances
-from geopy.geocoders import Nominatim  # Import Nominatim for geocoding
+import numpy as np  # Import numpy for vectorized calculations
 import streamlit as st  # Import Streamlit for creating web apps
 import requests  # Import requests for making HTTP requests
 
-@st.cache_data  # Cache the function's output to improve performance
-def query_station_status(url):
-    """Query station status from Tokyo bike-sharing API"""
-    with urllib.request.urlopen(url) as data_url:  # Open the URL
-        data = json.loads(data_url.read().decode())  # Read and decode the JSON data
-        df = pd.DataFrame(data['data']['stations'])  # Convert the data to a DataFrame
+def fetch_json(url):
+    """Fetch and parse a JSON document from the Tokyo bike-sharing API"""
+    r = requests.get(url, timeout=10)  # Make the API request, giving up on a stalled endpoint
+    r.raise_for_status()  # Fail on HTTP errors
+    return orjson.loads(r.content)  # Parse the raw bytes
+
+def parse_station_status(data):
+    """Build the active station status DataFrame from parsed API data"""
+    df = pd.DataFrame(data['data']['stations'])  # Convert the data to a DataFrame
     
     # Filter for active stations (renting and returning)
-    df = df[df['is_renting'] == True]  # Filter out stations that are not renting
-    df = df[df['is_returning'] == True]  # Filter out stations that are not returning
+    df = df[(df['is_renting'] == True) & (df['is_returning'] == True)]  # Filter out stations that are not renting or returning
     df = df.drop_duplicates(['station_id', 'last_reported'])  # Remove duplicate records
     
-    # Convert timestamp to datetime
-    df['last_reported'] = df['last_reported'].map(lambda x: dt.datetime.utcfromtimestamp(x))
+    # Convert timestamp to UTC datetime
+    ts = pd.to_datetime(df['last_reported'], unit='s', utc=True)
+    df['last_reported'] = ts
     
     # Add the last updated time to the DataFrame
-    df['time'] = df['last_reported']  # Use last_reported as time index
+    df['time'] = ts  # Use last_reported as time index
     df.index = df['time']  # Set the time as the index
-    df.index = df.index.tz_localize('UTC')  # Localize the index to UTC
     
     return df  # Return the DataFrame
 
+def parse_station_latlon(data):
+    """Build the station latitude and longitude DataFrame from parsed API data"""
+    return pd.DataFrame(data['data']['stations'])  # Convert the data to a DataFrame
+
+@st.cache_data  # Cache the function's output to improve performance
+def query_station_status(url):
+    """Query station status from Tokyo bike-sharing API"""
+    return parse_station_status(fetch_json(url))
+
+@st.cache_data  # Cache the function's output to improve performance
 def get_station_latlon(url):
     """Get station latitude and longitude from Tokyo bike-sharing API"""
-    with urllib.request.urlopen(url) as data_url:  # Open the URL
-        latlon = json.loads(data_url.read().decode())  # Read and decode the JSON data
-        latlon = pd.DataFrame(latlon['data']['stations'])  # Convert the data to a DataFrame
-    
-    return latlon  # Return the DataFrame
+    return parse_station_latlon(fetch_json(url))
 
 def join_latlon(df1, df2):
     """Join two DataFrames on station_id"""
@@ -57,6 +61,8 @@ def get_marker_color(num_bikes_available):
 
 def geocode(address):
     """Geocode an address using Nominatim"""
+    from geopy.geocoders import Nominatim  # Imported here since only geocoding needs geopy
+    
     geolocator = Nominatim(user_agent="tokyo-bike-demo")  # Create a geolocator object
     try:
         location = geolocator.geocode(address)  # Geocode the address
@@ -67,51 +73,35 @@ def geocode(address):
     except:
         return ''  # Return empty string on error
 
-def get_bike_availability(latlon, df):
-    """Calculate distance from each station to the user and return closest station with available bikes"""
-    i = 0
-    df = df.copy()  # Create a copy to avoid modifying original
-    df['distance'] = ''
+def _closest_with(df, latlon, col):
+    """Return [station_id, lat, lon] of the closest station with col > 0"""
+    lat1, lon1 = map(np.radians, latlon)  # User position in radians
+    lat2 = np.radians(df['lat'].to_numpy(dtype=np.float64))
+    lon2 = np.radians(df['lon'].to_numpy(dtype=np.float64))
+    
+    # Haversine distance (km) to every station in one pass
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    dist = 2 * 6371.0 * np.arcsin(np.sqrt(a))
     
-    while i < len(df):
-        df.loc[i, 'distance'] = geodesic(latlon, (df['lat'].iloc[i], df['lon'].iloc[i])).km  # Calculate distance to each station
-        i = i + 1
+    df = df.assign(distance=dist)  # Avoid modifying original
     
-    # Remove stations without available bikes
-    df = df.loc[df['num_bikes_available'] > 0]
+    # Remove stations without availability
+    df = df[df[col] > 0]
     
     if len(df) == 0:
-        return None  # No available bikes
+        return None  # Nothing available
     
-    chosen_station = []
-    chosen_station.append(df[df['distance'] == min(df['distance'])]['station_id'].iloc[0])  # Get closest station
-    chosen_station.append(df[df['distance'] == min(df['distance'])]['lat'].iloc[0])
-    chosen_station.append(df[df['distance'] == min(df['distance'])]['lon'].iloc[0])
+    closest = df.iloc[df['distance'].to_numpy().argmin()]  # Get closest station
     
-    return chosen_station  # Return the chosen station
+    return [closest['station_id'], closest['lat'], closest['lon']]  # Return the chosen station
+
+def get_bike_availability(latlon, df):
+    """Calculate distance from each station to the user and return closest station with available bikes"""
+    return _closest_with(df, latlon, 'num_bikes_available')
 
 def get_dock_availability(latlon, df):
     """Calculate distance from each station to the user and return closest station with available docks"""
-    i = 0
-    df = df.copy()  # Create a copy to avoid modifying original
-    df['distance'] = ''
-    
-    while i < len(df):
-        df.loc[i, 'distance'] = geodesic(latlon, (df['lat'].iloc[i], df['lon'].iloc[i])).km  # Calculate distance to each station
-        i = i + 1
-    
-    # Remove stations without available docks
-    df = df.loc[df['num_docks_available'] > 0]
-    
-    if len(df) == 0:
-        return None  # No available docks
-    
-    chosen_station = []
-    chosen_station.append(df[df['distance'] == min(df['distance'])]['station_id'].iloc[0])  # Get closest station
-    chosen_station.append(df[df['distance'] == min(df['distance'])]['lat'].iloc[0])
-    chosen_station.append(df[df['distance'] == min(df['distance'])]['lon'].iloc[0])
-    
-    return chosen_station  # Return the chosen station
+    return _closest_with(df, latlon, 'num_docks_available')
 
 def run_osrm(chosen_station, iamhere):
     """Run OSRM and get route coordinates and duration"""
@@ -126,13 +116,8 @@ def run_osrm(chosen_station, iamhere):
         print("Calling API ...:", r.status_code)  # Print the status code
         routejson = r.json()  # Parse the JSON response
         
-        coordinates = []
-        i = 0
         lst = routejson['routes'][0]['geometry']['coordinates']
-        
-        while i < len(lst):
-            coordinates.append([lst[i][1], lst[i][0]])  # Extract coordinates
-            i = i + 1
+        coordinates = np.asarray(lst, dtype=np.float64)[:, [1, 0]].tolist() if lst else []  # Swap [lon, lat(, alt)] to [lat, lon]
         
         duration = round(routejson['routes'][0]['duration'] / 60, 1)  # Convert duration to minutes
         